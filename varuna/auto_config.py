@@ -3,6 +3,9 @@ import math
 import os
 import torch
 import pickle
+import json
+
+from .partitioned_model import DRY_RUN_CACHE_FILE
 
 class AutoConfig:
 
@@ -153,12 +156,12 @@ class AutoConfig:
             self.all_reduce_profile = pickle.load(f)
 
     def read_model_structure(self):
-        with open("_tmp_inp_shapes",'rb') as f:
-            input_shapes = pickle.load(f)
+        with open(DRY_RUN_CACHE_FILE,'r') as f:
+            meta = json.load(f)
+        input_shapes = meta["inp_shapes"]
         input_shapes_keys = list(input_shapes.keys())
         self.input_shapes = [input_shapes[k][0] for k in input_shapes_keys]
-        with open("_tmp_shape_changes",'rb') as f:
-            shape_indices_to_change = pickle.load(f)
+        shape_indices_to_change = meta["shape_changes"]
         self.shape_indices_to_change = [shape_indices_to_change[k][0] for k in input_shapes_keys]
         self.num_pstages = len(self.input_shapes) + 1
         if verbose:
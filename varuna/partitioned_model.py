@@ -2,14 +2,40 @@ import torch
 import torch.distributed as dist
 from torch.nn import Module
 
-import os, sys
-import inspect
+import os
 import time
-import pickle
+import json
+import types
 
 from .utils import save_rng_states, restore_rng_states, VARUNA_TEMP_FOLDER
 
 from collections import OrderedDict 
+from queue import Empty
+
+DRY_RUN_CACHE_FILE = os.path.join(VARUNA_TEMP_FOLDER, "dry_run_meta.json")
+PSTAGE_CACHE_FILE = os.path.join(VARUNA_TEMP_FOLDER, "pstage_mapping.json")
+DRY_RUN_META_KEYS = ("ord_mod", "inp_shapes", "shape_changes", "inp_grads")
+
+def dry_run_cache_valid():
+    """ True only if the cache holds a complete dry-run meta. The profiler
+    writes a partial meta (ord_mod/inp_shapes) to the same file, which a
+    later training run with from_cache must regenerate, not trust """
+    try:
+        with open(DRY_RUN_CACHE_FILE, 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return all(k in meta for k in DRY_RUN_META_KEYS)
+
+def atomic_json_dump(obj, filename):
+    """ writes the metadata atomically, so readers never see a torn file
+    if the writer crashes mid-way; the payload is plain dicts/lists of
+    ints and strings, for which JSON is faster and smaller than pickle """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_filename, filename)
 
 class CutPoint(Module):
 
@@ -26,65 +52,51 @@ class CutPoint(Module):
         self.num_chunks = -1
         self.num_stages = -1
         self.fp16 = False
+        self.dtype = torch.float32
         self.pruning = False
         self.barrier_event = None
         self.boundary_func = None
         self.forward_input_shapes = None
         self.dummy_shapes = None
+        self.dummy_tensors = None
+        self.dummy_loss = None
         self.trimmed = False
 
         self.set_shapes = None
         self.forward_counter = 0
+
+        # "full": boundary gradients are sent as soon as backward reaches
+        # the cutpoint. "inputs_only": the send is deferred until
+        # flush_pending_grads(), so zero-bubble style schedules can run the
+        # input-grad pass without triggering boundary comm and flush after
+        # the weight-grad pass.
+        self.backward_mode = "full"
+        self.pending_grad_sends = []
     
     def set_pruning(self, boolean):
         self.pruning = boolean
 
+    def set_backward_mode(self, mode):
+        assert mode in ("full", "inputs_only"), f"Unknown backward mode {mode}"
+        self.backward_mode = mode
+
+    def flush_pending_grads(self):
+        for grad_output in self.pending_grad_sends:
+            self.send_fn(grad_output, grads = True)
+        self.pending_grad_sends = []
+
     def forward(self, *inputs, **kwargs):
-        # not set by ModelParallel, pass through as is
+        # not set by ModelParallel, pass through as is.
+        # set_cp_func binds the boundary version over this one, so no
+        # per-call dispatch on cp_func is needed here
         if self.barrier_event is not None:
             self.barrier_event.record()
         if self.boundary_func is not None:
             self.boundary_func()
-        
-        if self.cp_func is None:
-            if len(inputs) == 1:
-                return inputs[0]
-            return inputs
 
-        if self.trimmed:
-            dtype = torch.float16 if self.fp16 else torch.float32
-            dummy_inputs = []
-            for i,shape in enumerate(self.dummy_shapes):
-                dummy_inputs.append(torch.rand(*shape, requires_grad = self.bwd_req_grads[i], dtype=dtype).to(self.device))
-            inputs = tuple(dummy_inputs)
-
-        if len(inputs) < 0 or None in inputs:
-            if self.pruning:
-                inputs = (torch.tensor([-1.0], requires_grad = True))
-                inputs = (inputs,)
-            else:
-                dtype = torch.float16 if self.fp16 else torch.float32
-                tensor_inputs = []
-                for i in range(len(inputs)):
-                    tensor_inputs.append(torch.tensor([-1.0], requires_grad = self.bwd_req_grads[i], dtype=dtype).to(self.device))
-                inputs = tuple(tensor_inputs)
-
-        if isinstance(self.cp_func, torch.autograd.Function):
-            if self.cp_index == self.stage + 1 and self.stage != self.num_stages-1:
-                # New pipeline/iteration: dynamically set shapes of communicated tensors
-                if self.forward_counter%(2 * self.num_chunks) == 0:
-                    self.forward_counter = 0
-                    # my own bwd grad shapes and next gpu's fwd shapes.
-                    inp_shapes = [list(i.size()) for i in inputs]
-                    self.set_shapes(inp_shapes)
-
-                self.forward_counter += 1
-            out = self.cp_func.apply(*inputs)
-            if self.cp_index == (self.stage + 1):
-                self.set_ret_val_func(out) 
-            return out
-        
-        return self.cp_func(*inputs, **kwargs)
+        if len(inputs) == 1:
+            return inputs[0]
+        return inputs
 
     def set_cp_func(self):
         
@@ -99,7 +111,7 @@ class CutPoint(Module):
                 if is_in_next_stage and self.recv_fn is not None:
                     i = self.recv_fn()
                     if self.trimmed:
-                        return torch.rand(1, requires_grad=True).to(self.device) # DUMMY LOSS FOR PROFILING
+                        return self.dummy_loss # DUMMY LOSS FOR PROFILING
 
                 # send activations
                 elif is_in_prev_stage and self.send_fn is not None:
@@ -113,17 +125,17 @@ class CutPoint(Module):
             def backward(ctx, *grad_output):
                 if self.trimmed:
                     # PyTorch requires that backward function returns same number of values that Forward was called with
-                    dummies = []
-                    for i,shape in enumerate(self.dummy_shapes):
-                        dummies.append(torch.rand(*shape, requires_grad=True).to(self.device))
-                    grad_output = tuple(dummies)
+                    grad_output = tuple(self.dummy_tensors)
 
                 # receive gradients.
                 if is_in_prev_stage and self.recv_fn is not None:
                     grad_output = self.recv_fn(grads = True)
                 # send gradients
                 elif is_in_next_stage and self.send_fn is not None:
-                    self.send_fn(grad_output, grads = True)
+                    if self.backward_mode == "inputs_only":
+                        self.pending_grad_sends.append(grad_output)
+                    else:
+                        self.send_fn(grad_output, grads = True)
 
                 if len(grad_output) == 1:
                     return grad_output[0]
@@ -131,13 +143,61 @@ class CutPoint(Module):
 
         c = CutpointFunction()
         self.cp_func = c
+        # bind the boundary forward once instead of branching on the type
+        # of cp_func for every microbatch
+        self.forward = types.MethodType(_cutpoint_boundary_forward, self)
 
-
-def dry_run(model, get_batch, from_cache):
-    # executes the forward pass of the module on dummy inputs. 
+    def unset_cp_func(self):
+        self.cp_func = None
+        if 'forward' in self.__dict__:
+            del self.__dict__['forward']
+
+
+def _cutpoint_boundary_forward(self, *inputs, **kwargs):
+    # forward for cutpoints at a stage boundary, bound by set_cp_func
+    if self.barrier_event is not None:
+        self.barrier_event.record()
+    if self.boundary_func is not None:
+        self.boundary_func()
+
+    if self.trimmed:
+        # persistent dummy buffers, allocated once in attach_meta;
+        # their values are never consumed on the profiling path
+        inputs = tuple(self.dummy_tensors)
+
+    if len(inputs) < 0 or None in inputs:
+        if self.pruning:
+            inputs = (torch.tensor([-1.0], requires_grad = True))
+            inputs = (inputs,)
+        else:
+            tensor_inputs = []
+            for i in range(len(inputs)):
+                tensor_inputs.append(torch.tensor([-1.0], requires_grad = self.bwd_req_grads[i], dtype=self.dtype).to(self.device))
+            inputs = tuple(tensor_inputs)
+
+    if self.cp_index == self.stage + 1 and self.stage != self.num_stages-1:
+        # New pipeline/iteration: dynamically set shapes of communicated tensors
+        if self.forward_counter%(2 * self.num_chunks) == 0:
+            self.forward_counter = 0
+            # my own bwd grad shapes and next gpu's fwd shapes.
+            inp_shapes = [list(i.size()) for i in inputs]
+            self.set_shapes(inp_shapes)
+
+        self.forward_counter += 1
+    out = self.cp_func.apply(*inputs)
+    if self.cp_index == (self.stage + 1):
+        self.set_ret_val_func(out)
+    return out
+
+
+def dry_run(model, get_batch, from_cache, device=None):
+    # executes the forward pass of the module on dummy inputs.
     # Sets the order in which modules are used and the total number of cutpoints declared.
 
-    dummy_inputs = get_batch(1, device='cpu')
+    if device is None:
+        device = torch.device("cpu")
+    on_gpu = device.type == "cuda"
+
     ordered_modules = OrderedDict()
     input_shapes = {}
     input_gradients = {} 
@@ -166,65 +226,80 @@ def dry_run(model, get_batch, from_cache):
             num_cutpoints += 1
     print("Num cutpoints is", num_cutpoints)
     
-    # TODO: do this extra compute on GPU? large models...
-    model(**dummy_inputs)
-    input_shapes_1 = input_shapes
-    input_shapes = dict()
-    dummy_inputs_2 = get_batch(2, 'cpu')
-    model(**dummy_inputs_2)
-    input_shapes_2 = input_shapes
-    input_shapes = input_shapes_1
-
-    shape_indices_to_change = dict()
-    for name in input_shapes:
-        shape_indices_to_change[name] = []
-
-        # iterate through list of tensor-shapes for named cutpoint
-        for idx, shape in enumerate(input_shapes_1[name]):
-            shape_1 = shape
-            shape_2 = input_shapes_2[name][idx]
-            assert len(shape_1) == len(shape_2) # same nr of dimensions
-            indices_to_change = []
-            for i, d1 in enumerate(shape_1): # iterate through each dimension
-                d2 = shape_2[i]
-                if d1 == 1 and d2 == 2:
-                    indices_to_change.append(i) # batch-size index
-            shape_indices_to_change[name].append(indices_to_change) # append list of indices of batch-size-sensitive dimensions for tensor at idx
+    def trace(dev):
+        model(**get_batch(1, device=dev))
+        batch1 = { name: [list(s) for s in shapes]
+                    for name, shapes in input_shapes.items() }
+        model(**get_batch(2, device=dev))
+        return batch1
+
+    # the shape-discovery forward can run on GPU: rank 0 runs alone here
+    # (peers wait on the metadata broadcast), so device memory is free and
+    # a transformer-scale trace is orders of magnitude faster than on CPU.
+    # grad mode stays on because input_gradients records requires_grad.
+    # The full unpartitioned model may not fit on one device, though:
+    # VARUNA_CPU_DRY_RUN=1 skips the GPU attempt, and an OOM during the
+    # trace falls back to the CPU path.
+    if on_gpu and os.environ.get("VARUNA_CPU_DRY_RUN", "0") != "0":
+        on_gpu = False
+        device = torch.device("cpu")
+    if on_gpu:
+        try:
+            model.to(device)
+            shapes_batch1 = trace(device)
+        except RuntimeError as e:
+            # string match instead of torch.cuda.OutOfMemoryError, which
+            # older torch versions don't have
+            if "out of memory" not in str(e):
+                raise
+            print("Dry run out of memory on", device, "- retracing on cpu")
+            on_gpu = False
+            device = torch.device("cpu")
+        finally:
+            model.to("cpu")
+            torch.cuda.empty_cache()
+    if not on_gpu:
+        shapes_batch1 = trace(device)
+
+    # a dimension is batch-size-sensitive exactly when it changes between
+    # the batch=1 and batch=2 forwards; matching dims that merely equal the
+    # batch size would misflag constant size-2 dims (pair coordinates,
+    # 2-way heads, ...). For each cutpoint: a list (one per input tensor)
+    # of the indices of batch-size-sensitive dimensions.
+    shape_indices_to_change = {
+        name: [ [i for i, (d1, d2) in enumerate(zip(s1, s2)) if d1 == 1 and d2 == 2]
+                for s1, s2 in zip(shapes_batch1[name], input_shapes[name]) ]
+        for name in input_shapes }
 
     for h in hooks:
         h.remove()
 
-    # TODO: move to proper temp location
-    with open("_tmp_ord_mod",'wb') as f:
-        pickle.dump(list(ordered_modules.keys()),f)
-    with open("_tmp_inp_shapes",'wb') as f:
-        pickle.dump(input_shapes,f)
-    with open("_tmp_shape_changes",'wb') as f:
-        pickle.dump(shape_indices_to_change,f)
-    with open("_tmp_inp_grads",'wb') as f:
-        pickle.dump(input_gradients,f)
+    # the hooks left the batch-2 shapes in input_shapes, which only the
+    # diff above needs; everything downstream (auto_config's comm sizes,
+    # the trimmed-profiling dummies) expects the batch-1 base
+    input_shapes = shapes_batch1
+
+    meta = {"ord_mod": list(ordered_modules.keys()),
+            "inp_shapes": input_shapes,
+            "shape_changes": shape_indices_to_change,
+            "inp_grads": input_gradients}
+    atomic_json_dump(meta, DRY_RUN_CACHE_FILE)
 
     return ordered_modules, input_shapes, \
             shape_indices_to_change, input_gradients, num_cutpoints
 
 def read_dry_run_out(model):
-    with open("_tmp_ord_mod",'rb') as f:
-        ordered_modules_keys = pickle.load(f)
+    with open(DRY_RUN_CACHE_FILE,'r') as f:
+        meta = json.load(f)
+    ordered_modules_keys = meta["ord_mod"]
 
-    ordered_modules = OrderedDict()
-    for n in ordered_modules_keys:
-        path = n.split(".")
-        modules = model._modules
-        for i in range(len(path) - 1):
-            modules = modules[path[i]]._modules
-        ordered_modules[n] = modules[path[-1]]
+    # one named_modules() walk instead of a dotted-path descent per key
+    module_dict = dict(model.named_modules())
+    ordered_modules = OrderedDict((n, module_dict[n]) for n in ordered_modules_keys)
 
-    with open("_tmp_inp_shapes",'rb') as f:
-        input_shapes = pickle.load(f)
-    with open("_tmp_shape_changes",'rb') as f:
-        shape_indices_to_change = pickle.load(f)
-    with open("_tmp_inp_grads",'rb') as f:
-        input_gradients = pickle.load(f)
+    input_shapes = meta["inp_shapes"]
+    shape_indices_to_change = meta["shape_changes"]
+    input_gradients = meta["inp_grads"]
 
 
     num_cutpoints = len(input_shapes)
@@ -243,6 +318,9 @@ class PartitionedModel(Module):
         self.rank = rank
         self.local_rank = local_rank
         self.fp16 = fp16
+        # resolve the comm dtype once; the send/recv closures run per
+        # microbatch and shouldn't re-evaluate this ternary
+        self.dtype = torch.float16 if fp16 else torch.float32
         self.shared_weights = shared_weights
         self.chunks = chunks
 
@@ -263,13 +341,19 @@ class PartitionedModel(Module):
         self.pre_cp = None
         self.post_cp = None
 
-        self.stage = -1
-        for stage in self.stage_to_rank_map:
-            if self.rank in self.stage_to_rank_map[stage]:
-                self.stage = stage
-                break
-        else:
-            raise ValueError("Rank " + self.rank + " not found in stage to rank map!")
+        # pinned staging buffers for the recompute-context stash, keyed by
+        # (shape, dtype); reused across microbatches so the D2H offload is
+        # a fast pinned copy instead of a fresh pageable allocation
+        self._pinned_pools = {}
+        # the stash itself runs on its own stream so the next microbatch's
+        # forward doesn't wait behind the D2H copies
+        self._save_stream = torch.cuda.Stream() if self.device.type == "cuda" else None
+
+        rank_to_stage = { r: stage for stage, ranks in self.stage_to_rank_map.items()
+                            for r in ranks }
+        if self.rank not in rank_to_stage:
+            raise ValueError("Rank " + str(self.rank) + " not found in stage to rank map!")
+        self.stage = rank_to_stage[self.rank]
 
         if profiling_stages is not None:
             self.profiling_stages = [int(i) for i in profiling_stages.split(',')]
@@ -283,6 +367,7 @@ class PartitionedModel(Module):
         # print("Initializing partitioned model!")
         start = time.time()
         self.dry_run(get_batch_fn, from_cache)
+        self.build_module_index()
 
         if self.stage_to_cut is None:
             cuts_per_stage = int((self.num_cutpoints + 1)/self.num_stages)
@@ -311,29 +396,42 @@ class PartitionedModel(Module):
         self.model_pruned = True
 
     def dry_run(self, get_batch, from_cache):
-
-        if self.local_rank == 0 and not (from_cache and \
-            all([os.path.exists(f) for f in ["_tmp_ord_mod","_tmp_inp_shapes","_tmp_shape_changes"]])):
-
-            self.ordered_modules, self.input_shapes, self.shape_indices_to_change, \
-                self.input_gradients, self.num_cutpoints = dry_run(self.module, get_batch, from_cache)
-            dist.barrier()
-        else:
-            dist.barrier()
-            self.ordered_modules, self.input_shapes, self.shape_indices_to_change, \
-                self.input_gradients, self.num_cutpoints = read_dry_run_out(self.module)
+        # rank 0 traces the model (or loads the cached metadata) and
+        # broadcasts it to all peers; re-reading the pickle on every rank
+        # was a thundering herd on shared filesystems
+        meta = [None]
+        if self.rank == 0:
+            if not (from_cache and dry_run_cache_valid()):
+                self.ordered_modules, self.input_shapes, self.shape_indices_to_change, \
+                    self.input_gradients, self.num_cutpoints = dry_run(self.module, get_batch,
+                                                                from_cache, device=self.device)
+            else:
+                self.ordered_modules, self.input_shapes, self.shape_indices_to_change, \
+                    self.input_gradients, self.num_cutpoints = read_dry_run_out(self.module)
+                print("Num cutpoints is", self.num_cutpoints)
+            meta = [( list(self.ordered_modules.keys()), self.input_shapes,
+                      self.shape_indices_to_change, self.input_gradients, self.num_cutpoints )]
+        dist.broadcast_object_list(meta, src=0)
+        if self.rank != 0:
+            ordered_module_keys, self.input_shapes, self.shape_indices_to_change, \
+                self.input_gradients, self.num_cutpoints = meta[0]
+            # module names are shared; reconstruct the module objects locally
+            module_dict = dict(self.module.named_modules())
+            self.ordered_modules = OrderedDict((n, module_dict[n]) for n in ordered_module_keys)
             print("Num cutpoints is", self.num_cutpoints)
 
-            
-        if self.local_rank == 0 and not (from_cache and os.path.exists("_tmp_pstage_mapping")):
-            dummy_inputs = get_batch(1, "cpu")
-            # TODO: do we really need these many dry runs?
-            self.trace_and_store_param_access(dummy_inputs)
-            dist.barrier()
-        else:
-            dist.barrier()
-            with open("_tmp_pstage_mapping", 'rb') as f:
-                self.param_name_to_pstage = pickle.load(f)
+        pstage_mapping = [None]
+        if self.rank == 0:
+            if not (from_cache and os.path.exists(PSTAGE_CACHE_FILE)):
+                dummy_inputs = get_batch(1, "cpu")
+                # TODO: do we really need these many dry runs?
+                self.trace_and_store_param_access(dummy_inputs)
+            else:
+                with open(PSTAGE_CACHE_FILE, 'r') as f:
+                    self.param_name_to_pstage = json.load(f)
+            pstage_mapping = [self.param_name_to_pstage]
+        dist.broadcast_object_list(pstage_mapping, src=0)
+        self.param_name_to_pstage = pstage_mapping[0]
 
     def trace_and_store_param_access(self, dummy_inputs):
         param_access = dict()
@@ -341,30 +439,42 @@ class PartitionedModel(Module):
             param_access[p] = set()
 
         self.track_cp = 0
-        
-        def trace_param_access(frame, event, arg):
-            if event != 'call':
-                return
-            co = frame.f_code
-            func_name = co.co_name
-            if func_name in ['write','__hash__']:
-                return
-            arg_info = inspect.getargvalues(frame)
-            arg_values = [arg_info.locals[n] for n in arg_info.args]
-            for arg in arg_values:
-                if isinstance(arg, torch.nn.Parameter):
-                    if arg in param_access:
-                        param_access[arg].add(self.track_cp)
-        
+
+        # attribute each module's own parameters to the cutpoint interval
+        # in which the module runs; O(#modules) hook calls instead of a
+        # settrace callback on every Python function call
+        def record_param_access(module):
+            for p in module._parameters.values():
+                if p is not None and p in param_access:
+                    param_access[p].add(self.track_cp)
+
+        def param_access_pre_hook(module, inputs):
+            record_param_access(module)
+
+        def param_access_post_hook(module, inputs, output):
+            record_param_access(module)
+
         def boundary_func():
             self.track_cp += 1
+        hooks = []
         for name, module in self.module.named_modules():
             if isinstance(module, CutPoint):
                 module.boundary_func = boundary_func
-        sys.settrace(trace_param_access)
+            elif next(module.children(), None) is None:
+                # a leaf's whole forward runs inside one cutpoint interval,
+                # so the interval at entry is the interval of use
+                hooks.append(module.register_forward_pre_hook(param_access_pre_hook))
+            elif any(p is not None for p in module._parameters.values()):
+                # a container's forward can span cutpoints, so its entry
+                # interval says nothing about where its direct parameters
+                # are used. Those (e.g. a root-registered lm head weight)
+                # are applied at the tail of forward in practice, so
+                # attribute them to the interval where the forward ends.
+                hooks.append(module.register_forward_hook(param_access_post_hook))
         with torch.no_grad():
             self.module(**dummy_inputs)
-        sys.settrace(None)
+        for h in hooks:
+            h.remove()
         self.track_cp = None
 
         for name in self.ordered_modules:
@@ -396,15 +506,22 @@ class PartitionedModel(Module):
 
         self.param_name_to_pstage = param_name_to_pstage
 
-        with open("_tmp_pstage_mapping",'wb') as f:
-            pickle.dump(self.param_name_to_pstage,f)
+        atomic_json_dump(self.param_name_to_pstage, PSTAGE_CACHE_FILE)
         
     
     def find_shared_weight_stages(self):
         # TODO: this method is wrong, do trace thing
+        # split each shared weight name once into (module name, param name)
+        # and bucket by module, so the ordered-modules walk below is a dict
+        # lookup per module instead of a scan over every shared weight
         all_shared_weights = []
+        module_to_weights = dict()
         for w_pair in self.shared_weights:
-            all_shared_weights += [w for w in w_pair]
+            for w in w_pair:
+                all_shared_weights.append(w)
+                module_name, _, param_name = w.rpartition(".")
+                module_to_weights.setdefault(module_name, []).append((w, param_name))
+
         curr_stage = 0
         weight_stages = dict()
         for m in self.ordered_modules:
@@ -412,19 +529,15 @@ class PartitionedModel(Module):
             if isinstance(module, CutPoint):
                 curr_stage += 1
                 continue
-            for w in all_shared_weights:
-                param_name = w.split(".")[-1]
-                module_name = w[ : -len(param_name)-1]
-                if m == module_name and hasattr(module, param_name):
+            for w, param_name in module_to_weights.get(m, ()):
+                if hasattr(module, param_name):
                     weight_stages[w] = curr_stage
-                    break
-                elif m == module_name:
+                else:
                     print("Here we have the peculiar case of the missing weight", m, param_name)
-                    print(getattr(module,param_name))
-        
+
         for w in all_shared_weights:
             if w not in weight_stages:
-                param_name = w.split(".")[-1]
+                param_name = w.rpartition(".")[-1]
                 if hasattr(self.module, param_name):
                     weight_stages[w] = curr_stage
 
@@ -451,6 +564,20 @@ class PartitionedModel(Module):
         self.shared_weight_stages = shared_weight_stages
 
 
+    def build_module_index(self):
+        # single walk over the module tree: full dotted name -> module and
+        # -> (parent._modules dict, leaf key), so that pruning does not
+        # re-split and descend dotted paths for every module/parameter
+        name_to_module = {"": self.module}
+        self._module_index = {}
+        for name, module in self.module.named_modules():
+            if name == "":
+                continue
+            name_to_module[name] = module
+            parent_name, _, key = name.rpartition(".")
+            self._module_index[name] = (name_to_module[parent_name]._modules, key)
+        self._name_to_module = name_to_module
+
     # """ setting actual cutpoint functions for comunication. """
     def prep_cutpoints(self):
 
@@ -461,12 +588,19 @@ class PartitionedModel(Module):
             cutpoint.stage = self.stage
             cutpoint.device = self.device
             cutpoint.fp16 = self.fp16
+            cutpoint.dtype = self.dtype
             cutpoint.bwd_req_grads = bwd_req_grads
             cutpoint.num_chunks = self.chunks
             cutpoint.num_stages = self.num_stages
             cutpoint.set_shapes = self.set_shapes
             cutpoint.trimmed = self.trimmed
             cutpoint.dummy_shapes = shapes
+            if self.trimmed:
+                # reused across all microbatches on the profiling path
+                cutpoint.dummy_tensors = [ torch.empty(*shape, dtype=self.dtype,
+                                            device=self.device, requires_grad=bwd_req_grads[i])
+                                           for i, shape in enumerate(shapes) ]
+                cutpoint.dummy_loss = torch.empty(1, device=self.device, requires_grad=True)
             cutpoint.set_cp_func()
 
         # self.cuts_per_stage = (self.num_cutpoints + 1) // self.num_stages
@@ -543,12 +677,8 @@ class PartitionedModel(Module):
 
         for m in is_used:
             if not is_used[m]:
-                path = m.split(".")
-                modules = self.module._modules
-                for i in range(len(path) - 1):
-                    modules = modules[path[i]]._modules
-                modules[path[-1]] = None
-                modules[path[-1]] = PassThroughModule()
+                parent_modules, key = self._module_index[m]
+                parent_modules[key] = PassThroughModule()
                 self.ordered_modules[m] = None
 
         self.check_unused_parameters()
@@ -596,21 +726,35 @@ class PartitionedModel(Module):
         start_pstage = self.stage_to_cut[self.stage]
         end_pstage = self.stage_to_cut[self.stage+1] if self.stage < (self.num_stages - 1) else (self.num_cutpoints + 1)
 
-        for n,p in self.module.named_parameters():
-            if n not in self.param_name_to_pstage:
-                # print(f"{n} not in pstage map")
-                continue
-            pstage = self.param_name_to_pstage[n]
-            if pstage != -1 and (pstage < start_pstage or pstage >= end_pstage):
-                # to_remove.append(n)
-                path = n.split(".")
-                parent = self.module
-                for i in range(len(path) - 1):
-                    parent = getattr(parent, path[i])
-                setattr(parent,path[-1], None)
-        
+        # one named_parameters() walk to collect the out-of-range names,
+        # then batched nullification through the cached module index
+        pstage_map = self.param_name_to_pstage
+        out_of_range = [ n for n, _ in self.module.named_parameters()
+                         if pstage_map.get(n, -1) != -1 and
+                            not (start_pstage <= pstage_map[n] < end_pstage) ]
+        for n in out_of_range:
+            module_name, _, param_name = n.rpartition(".")
+            self._name_to_module[module_name]._parameters[param_name] = None
+
         self.model_pruned = True
 
+    def _acquire_pinned(self, tensor):
+        key = (tuple(tensor.size()), tensor.dtype)
+        pool = self._pinned_pools.setdefault(key, [])
+        if pool:
+            buf, last_use = pool.pop()
+            if last_use is not None:
+                # make sure the previous H2D copy out of this buffer is done
+                last_use.synchronize()
+            return buf
+        return torch.empty(tensor.size(), dtype=tensor.dtype, pin_memory=True)
+
+    def _release_pinned(self, buffers):
+        for buf in buffers:
+            last_use = torch.cuda.Event()
+            last_use.record()
+            self._pinned_pools[(tuple(buf.size()), buf.dtype)].append((buf, last_use))
+
     def set_ret_val(self, val):
         self.ret_val = val
 
@@ -640,18 +784,27 @@ class PartitionedModel(Module):
                     shapes = self.backward_grad_shapes
                 else:
                     shapes = self.forward_input_shapes
-                dtype = torch.float16 if self.fp16 else torch.float32
                 for i,shape in enumerate(shapes):
-                    dummy = torch.rand(*shape, requires_grad=True, dtype=dtype)
+                    # placeholder values are never consumed; skip the cuRAND fill
+                    dummy = torch.empty(*shape, requires_grad=True, dtype=self.dtype)
                     sendlist.append(dummy)
             else:
+                # keep tensors on-device; the comm workers send CUDA tensors
+                # directly over NCCL, so no D2H staging copy is needed here
                 for tensor in tensor_tuple:
-                    sendlist.append(tensor.cpu())
+                    sendlist.append(tensor)
+            # record an event on the compute stream so the sender thread can
+            # issue the isend on its own CUDA stream once the data is ready,
+            # overlapping communication with subsequent compute
+            event = None
+            if self.device.type == "cuda":
+                event = torch.cuda.Event()
+                event.record()
             if grads:
-                self.grads_send_queue.put(sendlist)
+                self.grads_send_queue.append((sendlist, event))
             else:
                 if not recompute:
-                    self.acts_send_queue.put(sendlist)
+                    self.acts_send_queue.append((sendlist, event))
 
         if self.pre_cp is not None:
             self.pre_cp.send_fn = send
@@ -662,29 +815,39 @@ class PartitionedModel(Module):
         acts = None
 
         if recompute:
-            rng_states, acts = self.recompute_queue.get()
+            rng_states, acts, ready = self.recompute_queue.get()
             restore_rng_states(rng_states, self.device)
+            if ready is not None:
+                # wait for the D2H stash, move back to device and return the
+                # pinned buffers to the pool
+                ready.synchronize()
+                pinned = acts
+                acts = tuple(a.to(self.device, non_blocking=True) for a in pinned)
+                self._release_pinned(pinned)
         elif self.stage > 0:
+            # block on the queue instead of spinning on empty(); wake up
+            # periodically to surface exceptions from the comm threads
             while acts is None:
-                if not self.excp_queue.empty():
-                    e = self.excp_queue.get()
-                    raise e
-                if not self.acts_queue.empty():
-                    acts = self.acts_queue.get()
+                try:
+                    acts = self.acts_queue.get(timeout=0.01)
+                except Empty:
+                    if not self.excp_queue.empty():
+                        raise self.excp_queue.get()
             # acts is a list of tensors or None
         if self.stage > 0:
-            acts = tuple(a.to(self.device) for a in acts)
+            # no-op for tensors that are already on-device
+            acts = tuple(a.to(self.device, non_blocking=True) for a in acts)
 
         def recv(grads = False):
             if grads:
-                grds = None
-                while grds is None:
-                    if not self.excp_queue.empty():
-                        e = self.excp_queue.get()
-                        raise e
-                    if not self.grads_queue.empty():
-                        grds = self.grads_queue.get()
-                        return tuple(g.to(self.device) for g in grds)
+                while True:
+                    try:
+                        grds = self.grads_queue.get(timeout=0.01)
+                    except Empty:
+                        if not self.excp_queue.empty():
+                            raise self.excp_queue.get()
+                        continue
+                    return tuple(g.to(self.device, non_blocking=True) for g in grds)
             else:
                 return acts
         if self.pre_cp is not None:
@@ -694,10 +857,12 @@ class PartitionedModel(Module):
         return acts
 
     def set_recv_acts(self, shape, receive_rank): # BAZI TODO: part of evaluation
+        # one persistent receive buffer instead of a fresh zeros() per call;
+        # dist.recv overwrites every element anyway
+        recv_buf = torch.empty(shape, dtype=self.dtype)
         def recv(grads=False):
-            x = torch.zeros(shape, dtype=torch.float16 if self.fp16 else torch.float32)
-            dist.recv(x, receive_rank)
-            return x.to(self.device)
+            dist.recv(recv_buf, receive_rank)
+            return recv_buf.to(self.device, non_blocking=True)
         if self.pre_cp is not None:
             self.pre_cp.recv_fn = recv
 
@@ -776,9 +941,27 @@ class PartitionedModel(Module):
             self.clear_recording_events()
         
         if save_ctx:
+            ready = None
             if self.stage > 0:
-                recv_acts = tuple(r.cpu() for r in recv_acts)
-            ctx = (rng_states, recv_acts)
+                if self.device.type == "cuda":
+                    # capture the compute stream before switching streams
+                    compute_stream = torch.cuda.current_stream()
+                    with torch.cuda.stream(self._save_stream):
+                        self._save_stream.wait_stream(compute_stream)
+                        staged = []
+                        for r in recv_acts:
+                            buf = self._acquire_pinned(r)
+                            buf.copy_(r, non_blocking=True)
+                            staged.append(buf)
+                            # keep the allocator from recycling the source
+                            # while the copy is in flight on this stream
+                            r.record_stream(self._save_stream)
+                        recv_acts = tuple(staged)
+                        ready = torch.cuda.Event()
+                        ready.record()
+                else:
+                    recv_acts = tuple(r.cpu() for r in recv_acts)
+            ctx = (rng_states, recv_acts, ready)
             self.recompute_queue.put(ctx)
 
         return ret_val
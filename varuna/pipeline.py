@@ -6,7 +6,8 @@ import torch.distributed as dist
 from torchviz import make_dot, make_dot_from_trace
 
 from queue import Queue
-from threading import Thread
+from collections import deque
+from contextlib import nullcontext
 try:
     from apex import amp
     from apex.amp import _amp_state
@@ -18,12 +19,22 @@ import math
 import os, sys
 import time
 
+# quantized boundary transfers ship an extra scale tensor per payload;
+# its tag is the payload tag plus this offset
+QSCALE_TAG_OFFSET = 1 << 20
+
+# absmax range of each supported boundary quantization dtype
+QUANT_RANGE = { torch.int8: 127.0 }
+if hasattr(torch, "float8_e4m3fn"):
+    QUANT_RANGE[torch.float8_e4m3fn] = 448.0
+
 class Pipeline:
     """ Pipeline parallelism for Varuna """
 
-    def __init__(self, batches, model, config, schedule, optimizer, verbose=False):
-        self.batches = batches
-        self.chunks = len(self.batches)
+    def __init__(self, model, config, schedule, optimizer, verbose=False):
+        # one-time setup only; per-minibatch state is reset in run(batches)
+        # so a single Pipeline instance is reused across training steps
+        self.batches = None
 
         self.model = model
         self.partitioned_model = self.model
@@ -44,14 +55,43 @@ class Pipeline:
 
         self.optimizer = optimizer
 
-        self.spawn_send_workers()
-        # self.spawn_receive_workers()
+        # all comm is driven from the compute thread; the send handoffs are
+        # plain deques since producer and consumer share that thread and
+        # per-item mutex traffic buys nothing
+        self.acts_send_queue = deque()
+        self.grads_send_queue = deque()
         self.acts_queue = Queue()
         self.grads_queue = Queue()
         self.recompute_queue = Queue()
         self.grads_shape_queue = Queue()
         self.excp_queue = Queue()
 
+        # dedicated streams so P2P transfers don't serialize with compute
+        self.recv_stream = torch.cuda.Stream() if self.device.type == "cuda" else None
+        self.send_stream = torch.cuda.Stream() if self.device.type == "cuda" else None
+
+        self.comm_dtype = torch.float16 if self.fp16 else torch.float32
+        # microbatch arrival order per direction, computed once instead of
+        # re-scanning the schedule on every pipeline invocation
+        self._fwd_indexes = [index for task, index in self.schedule if task == 0]
+        self._bwd_indexes = [index for task, index in self.schedule if task == 2]
+        self.chunks = len(self._fwd_indexes)
+        # schedule pre-lowered to (task, microbatch, grad_mode) tuples so the
+        # run loop does no per-task lookahead; grad_mode marks a forward whose
+        # backward follows immediately, which makes recomputation unnecessary
+        self._plan = []
+        for i, (task, index) in enumerate(self.schedule):
+            grad_mode = task == 0 and i+1 < len(self.schedule) and self.schedule[i+1][0] == 2
+            self._plan.append((task, index, grad_mode))
+        self._pending_send_handles = []
+        # FIFOs of pre-posted (handles, tensors) receives, one per arrival
+        self._act_recvs = deque()
+        self._grad_recvs = deque()
+        self._header_sent = False
+        self._acts_sent = 0
+        self._grads_sent = 0
+        self._seed_grad_cache = {}
+
         # self.back_start_times = Queue()
 
         # communication queues
@@ -61,6 +101,9 @@ class Pipeline:
         # stores output of recompute(/forward) pass to be used by backward()
         self.loss = None
         self.average_loss = 0
+        # per-microbatch losses accumulate on device; read back once per
+        # minibatch instead of a blocking .item() per backward
+        self._loss_accum = torch.zeros((), dtype=torch.float32, device=self.device)
 
         self.pre_fwd_events = []
         self.post_fwd_events = []
@@ -71,6 +114,12 @@ class Pipeline:
         self.partitions = config["partitions"]
         self.stage = config["stage"]
         self.pipeline_group = config["pipeline_process_group"]
+        # NCCL group for boundary tensors; with it, payloads move directly
+        # between GPUs. Without it (cpu runs, or gloo-only setups) payloads
+        # are staged through host memory on the default group.
+        self.boundary_group = config.get("boundary_process_group", None)
+        self.comm_device = config["device"] if self.boundary_group is not None \
+                                else torch.device("cpu")
         self.rank_within_stage = config["rank_within_stage"]
 
         self.device = config["device"]
@@ -89,36 +138,14 @@ class Pipeline:
         self.receive_rank = config["receive_rank"]
         self.send_rank = config["send_rank"]
         self.last_chunk_size = config["last_chunk_size"]
+        # optional lossy compression of boundary tensors (off by default)
+        self.boundary_dtype = config.get("boundary_dtype", None)
+        if self.boundary_dtype is not None:
+            assert self.boundary_dtype in QUANT_RANGE, \
+                f"Unsupported boundary quantization dtype {self.boundary_dtype}"
     
-    def spawn_receive_workers(self):
-        self.acts_receive_thread = None
-        self.grads_receive_thread = None
-
-        if self.stage > 0:
-            self.acts_receive_thread = Thread(target=self.acts_receiver, args=())
-            self.acts_receive_thread.daemon=True
-            self.acts_receive_thread.start()
-
-        if self.stage < self.partitions-1:
-            self.grads_receive_thread = Thread(target=self.grads_receiver, args=())
-            self.grads_receive_thread.daemon=True
-            self.grads_receive_thread.start()
-    
-    def spawn_send_workers(self):
-        self.grads_send_queue = Queue()
-        self.acts_send_queue = Queue()
-        self.acts_send_thread = None
-        self.grads_send_thread = None
-
-        if self.stage < self.partitions-1:
-            self.acts_send_thread = Thread(target=self.acts_sender, args=())
-            self.acts_send_thread.daemon=True
-            self.acts_send_thread.start()
-
-        if self.stage > 0:
-            self.grads_send_thread = Thread(target=self.grads_sender, args=())
-            self.grads_send_thread.daemon=True
-            self.grads_send_thread.start() 
+    def _stream_ctx(self, stream):
+        return torch.cuda.stream(stream) if stream is not None else nullcontext()
 
     def shape_tensor(self, input_shapes):
         max_size = max(len(i) for i in input_shapes)
@@ -128,150 +155,188 @@ class Pipeline:
             while len(shape) < max_size:
                 shape.append(0)
         return torch.tensor(padded_shapes)
-    
-    def shape_setter(self):
-        shape_list = self.grads_shape_queue.get()
-        self.bwd_grad_shape = shape_list
-
-        shape_tensor = self.shape_tensor(shape_list)
-        handle = dist.isend(shape_tensor, dst=self.send_rank, tag=0)
-        handle.wait()
-
-    def acts_receiver(self):
-        chunks = len(self.batches)
-        dtype = torch.float16 if self.fp16 else torch.float32
-        recv_handles = Queue()
 
+    def _recv_shape_header(self):
+        # this stage's fwd input shapes are fixed by the previous stage's
+        # first forward and shipped as a tag-0 header in front of its acts
         max_size = max(len(i) for i in self.fwd_inp_shape)
-        received_shapes = torch.zeros((len(self.fwd_inp_shape), max_size),  dtype=torch.int64)
-        shape_handle = dist.irecv(received_shapes, src=self.receive_rank, tag=0)
-        shape_handle.wait()
-        input_shapes = []
+        received_shapes = torch.zeros((len(self.fwd_inp_shape), max_size), dtype=torch.int64)
+        dist.irecv(received_shapes, src=self.receive_rank, tag=0).wait()
 
+        input_shapes = []
         for idx, shp in enumerate(self.fwd_inp_shape):
             shape = received_shapes[idx, :len(shp)].tolist()
             input_shapes.append(shape)
-
         self.fwd_inp_shape = input_shapes
+        self._fwd_shapes = self._build_shape_table(self.fwd_inp_shape, self.fwd_inp_shape_changes)
 
-        for task,index in self.schedule:
-            if task == 0:
-                try:
-                    tensors = [None] * len(self.fwd_inp_shape)
-
-                    for i, fwd_inp_shape in enumerate(self.fwd_inp_shape):
-                        if index == (chunks-1) and self.last_chunk_size > 0:
-                            for d in self.fwd_inp_shape_changes[i]:
-                                fwd_inp_shape[d] = self.last_chunk_size
-
-                        tag_id = 1 + i + (index *  len(self.fwd_inp_shape))
-
-                        tensors[i] = torch.ones(fwd_inp_shape, dtype=dtype)
-                        handle = dist.irecv(tensors[i], src=self.receive_rank, tag=tag_id)
-                        recv_handles.put(handle)
-
-                    while not recv_handles.empty():
-                        handle = recv_handles.get()
-                        handle.wait()
-                    self.acts_queue.put(tensors)
-                except Exception as e:
-                    self.excp_queue.put(e)
-                    return
-        del tensors
-    
-    def grads_receiver(self):
-        chunks = len(self.batches)
+    def _send_shape_header(self):
+        # my bwd grad shapes double as the next stage's fwd input shapes
+        shape_list = self.grads_shape_queue.get()
+        self.bwd_grad_shape = shape_list
+        shape_tensor = self.shape_tensor(shape_list)
+        dist.isend(shape_tensor, dst=self.send_rank, tag=0).wait()
+        self._bwd_shapes = self._build_shape_table(self.bwd_grad_shape, self.bwd_grad_shape_changes)
+        self._header_sent = True
+
+    def _build_shape_table(self, shapes, shape_changes):
+        # resolve the per-microbatch shapes once; only the last chunk can
+        # differ, so every post just indexes the table
+        table = [shapes] * self.chunks
+        if self.last_chunk_size > 0:
+            adjusted = []
+            for shp, changes in zip(shapes, shape_changes):
+                shp = list(shp)
+                for d in changes:
+                    shp[d] = self.last_chunk_size
+                adjusted.append(shp)
+            table[-1] = adjusted
+        return table
+
+    def _quantize(self, t):
+        # absmax scaling into the boundary dtype; scale travels with the
+        # payload so the receiver can restore magnitudes
+        qmax = QUANT_RANGE[self.boundary_dtype]
+        amax = t.detach().float().abs().amax().clamp_(min=1e-12)
+        q = t.float().mul(qmax / amax)
+        if self.boundary_dtype == torch.int8:
+            q = q.round_()
+        return q.to(self.boundary_dtype), (amax / qmax).reshape(1)
+
+    def _dequantize(self, q, scale):
+        # scale is float32, so the product must be cast back down or fp16
+        # stages would see float32 boundary tensors
+        return (q.float() * scale).to(self.comm_dtype)
+
+    def _recv_ops(self, shp, peer, tag_id, tensors):
+        # one payload op, plus a scale op when boundary quantization is on
+        ops = []
+        if self.boundary_dtype is not None:
+            q = torch.empty(shp, dtype=self.boundary_dtype, device=self.comm_device)
+            scale = torch.empty(1, dtype=torch.float32, device=self.comm_device)
+            tensors.append((q, scale))
+            ops.append(dist.P2POp(dist.irecv, q, peer, group=self.boundary_group, tag=tag_id))
+            ops.append(dist.P2POp(dist.irecv, scale, peer, group=self.boundary_group,
+                                  tag=tag_id + QSCALE_TAG_OFFSET))
+        else:
+            # empty is fine since the receive overwrites every element
+            t = torch.empty(shp, dtype=self.comm_dtype, device=self.comm_device)
+            tensors.append(t)
+            ops.append(dist.P2POp(dist.irecv, t, peer, group=self.boundary_group, tag=tag_id))
+        return ops
+
+    def _send_ops(self, t, peer, tag_id):
+        if self.boundary_dtype is not None:
+            q, scale = self._quantize(t)
+            if self.boundary_group is None and q.is_cuda:
+                q, scale = q.cpu(), scale.cpu()
+            return [dist.P2POp(dist.isend, q.contiguous(), peer, group=self.boundary_group, tag=tag_id),
+                    dist.P2POp(dist.isend, scale, peer, group=self.boundary_group,
+                               tag=tag_id + QSCALE_TAG_OFFSET)]
+        if self.boundary_group is None and t.is_cuda:
+            # no NCCL group to carry device tensors; stage through the host
+            t = t.cpu()
+        return [dist.P2POp(dist.isend, t.contiguous(), peer, group=self.boundary_group, tag=tag_id)]
+
+    def _post_act_recv(self, index):
+        shapes = self._fwd_shapes[index]
+        with self._stream_ctx(self.recv_stream):
+            # buffers live on comm_device: on-GPU when the NCCL boundary
+            # group exists, pageable host memory otherwise
+            tensors = []
+            ops = []
+            for i, shp in enumerate(shapes):
+                tag_id = 1 + i + (index * len(self.fwd_inp_shape))
+                ops.extend(self._recv_ops(shp, self.receive_rank, tag_id, tensors))
+            handles = dist.batch_isend_irecv(ops)
+        return handles, tensors
+
+    def _post_grad_recv(self, index):
         tensors_per_chunk = len(self.bwd_grad_shape)
-        dtype = torch.float16 if self.fp16 else torch.float32
-        recv_handles = Queue()
-
-        # dynamically set grad shapes; must return before receiving grads
-        # also sends forward input shapes to next process
-        self.shape_setter()
-
-        for task,index in self.schedule:
-            if task == 2:
-                try:
-                    tensors = [None] * tensors_per_chunk
-
-                    for i, bwd_grad_shape in enumerate(self.bwd_grad_shape):
-                        if index == (chunks-1) and self.last_chunk_size > 0:
-                            for d in self.bwd_grad_shape_changes[i]:
-                                bwd_grad_shape[d] = self.last_chunk_size
-
-                        tensors[i] = torch.ones(bwd_grad_shape, dtype=dtype)
-                        # tag unique to this tensor in this micro-batch
-                        tag_id = 1 + (chunks * tensors_per_chunk) + (i + (index * tensors_per_chunk))
-                        handle = dist.irecv(tensors[i], src=self.send_rank, tag=tag_id)
-                        recv_handles.put(handle)
-
-                    while not recv_handles.empty():
-                        handle = recv_handles.get()
-                        handle.wait()
-                    self.grads_queue.put(tensors)
-                except Exception as e:
-                    # in case connection is closed
-                    self.excp_queue.put(e)
-                    return
-        del tensors
-
-    def acts_sender(self):
-        count = 0
-        for task,index in self.schedule:
-            if task == 0:
-                count += 1
-        
-        send_handles = Queue()
-        indexing_count = count
-        while count > 0:
-            output_acts = self.acts_send_queue.get() # list of acts
-            for i, act in enumerate(output_acts):
-                tag_id = 1 + i + ((indexing_count - count) *  len(self.bwd_grad_shape))
-                handle = dist.isend(act.contiguous(), dst=self.send_rank, tag=tag_id)
-                send_handles.put(handle)
-            if send_handles.qsize() > len(output_acts):
-                handle = send_handles.get()
-                handle.wait()
-            count -= 1
-        while not send_handles.empty():
-            handle = send_handles.get()
+        shapes = self._bwd_shapes[index]
+        with self._stream_ctx(self.recv_stream):
+            tensors = []
+            ops = []
+            for i, shp in enumerate(shapes):
+                # tag unique to this tensor in this micro-batch
+                tag_id = 1 + (self.chunks * tensors_per_chunk) + (i + (index * tensors_per_chunk))
+                ops.extend(self._recv_ops(shp, self.send_rank, tag_id, tensors))
+            handles = dist.batch_isend_irecv(ops)
+        return handles, tensors
+
+    def _wait_recv(self, pending):
+        handles, tensors = pending
+        for handle in handles:
             handle.wait()
-
-    def grads_sender(self):
-        chunks = len(self.batches)
-        tensors_per_chunk = len(self.fwd_inp_shape)
-
-        count = 0
-        for task,index in self.schedule:
-            if task == 2:
-                count += 1
-        
-        send_handles = Queue()
-        indexing_count = count
-        while count > 0:
-            input_grads = self.grads_send_queue.get()
-            for i, grad in enumerate(input_grads):
-                tag_id = 1 + (chunks * tensors_per_chunk) + (i + ((indexing_count - count) * tensors_per_chunk))
-                handle = dist.isend(grad.contiguous(), dst=self.receive_rank, tag=tag_id)
-                send_handles.put(handle)
-            if send_handles.qsize()>len(input_grads):
-                handle = send_handles.get()
-                handle.wait()
-            count -= 1
-        while not send_handles.empty():
-            handle = send_handles.get()
+        if self.recv_stream is not None:
+            self.recv_stream.synchronize()
+            # the buffers were allocated on recv_stream but are consumed
+            # (and freed) on the compute stream; without marking that use
+            # the allocator could hand a freed block to a later receive
+            # posted on recv_stream while compute kernels still read it
+            compute_stream = torch.cuda.current_stream()
+            for t in tensors:
+                for part in (t if isinstance(t, tuple) else (t,)):
+                    if part.is_cuda:
+                        part.record_stream(compute_stream)
+        if self.boundary_dtype is not None:
+            return [self._dequantize(q, scale) for q, scale in tensors]
+        return tensors
+
+    def _grads_in_flight_ready(self):
+        # drives the opportunistic reorder: run a forward instead if the
+        # grads for the next backward haven't arrived yet
+        if not self._grad_recvs:
+            return False
+        return all(h.is_completed() for h in self._grad_recvs[0][0])
+
+    def _drain_sends(self):
+        # issue whatever the last task produced as batched NCCL group calls;
+        # completion is only needed at the end of the pipeline, so handles
+        # accumulate instead of blocking the compute thread
+        while self.acts_send_queue:
+            output_acts, ready_event = self.acts_send_queue.popleft()
+            with self._stream_ctx(self.send_stream):
+                if ready_event is not None:
+                    ready_event.wait()
+                ops = []
+                for i, act in enumerate(output_acts):
+                    tag_id = 1 + i + (self._acts_sent * len(self.bwd_grad_shape))
+                    ops.extend(self._send_ops(act, self.send_rank, tag_id))
+                self._pending_send_handles.extend(dist.batch_isend_irecv(ops))
+            self._acts_sent += 1
+
+        while self.grads_send_queue:
+            # fwd_inp_shape is None on stage 0, which never sends grads
+            tensors_per_chunk = len(self.fwd_inp_shape)
+            input_grads, ready_event = self.grads_send_queue.popleft()
+            with self._stream_ctx(self.send_stream):
+                if ready_event is not None:
+                    ready_event.wait()
+                ops = []
+                for i, grad in enumerate(input_grads):
+                    tag_id = 1 + (self.chunks * tensors_per_chunk) + (i + (self._grads_sent * tensors_per_chunk))
+                    ops.extend(self._send_ops(grad, self.receive_rank, tag_id))
+                self._pending_send_handles.extend(dist.batch_isend_irecv(ops))
+            self._grads_sent += 1
+
+    def _finish_sends(self):
+        for handle in self._pending_send_handles:
             handle.wait()
-        
-    def close_comm_threads(self):
-        if self.acts_receive_thread is not None:
-            self.acts_receive_thread.join()
-        if self.grads_receive_thread is not None:
-            self.grads_receive_thread.join()
-
-        if self.acts_send_thread is not None:
-            self.acts_send_thread.join()
-        if self.grads_send_thread is not None:
-            self.grads_send_thread.join()
+        self._pending_send_handles = []
+
+    def _seed_grads(self, size):
+        # the boundary seed gradient is always ones of a known shape, so
+        # keep one per shape (the last chunk may differ) instead of paying
+        # an alloc + H2D copy on every backward
+        key = tuple(size)
+        grads = self._seed_grad_cache.get(key)
+        if grads is None:
+            # match the activation dtype so mixed precision doesn't insert
+            # a cast kernel at the boundary
+            grads = torch.ones(size, dtype=self.comm_dtype, device=self.device)
+            self._seed_grad_cache[key] = grads
+        return grads
 
     def worker(self, task, grad_mode, inputs_as_dict):
         """ Main body of worker loop """
@@ -312,12 +377,12 @@ class Pipeline:
         
         # backward
         else:
-            grads = torch.ones(self.loss.size(), dtype = torch.float32).to(self.device)
+            grads = self._seed_grads(self.loss.size())
 
             if self.stage == self.partitions - 1:
                 grads = None
                 self.loss = self.loss/self.chunks
-                self.average_loss += (self.loss.item())
+                self._loss_accum.add_(self.loss.detach())
 
             if self.fp16:
                 with amp.scale_loss(self.loss, self.optimizer, delay_overflow_check=True, 
@@ -329,49 +394,81 @@ class Pipeline:
             del self.loss
             self.loss = None
         
-    def run(self):
+    def run(self, batches):
         if self.verbose:
             print(f'{self.rank} {self.rank_within_stage} starting pipeline')        
 
-        self.spawn_receive_workers()
         batchstart = time.time()
 
-        schedule = [s for s in enumerate(self.schedule)]
+        # reset per-minibatch state; the shape header is re-exchanged every
+        # iteration because the model re-derives shapes per minibatch
+        self.batches = batches
+        assert len(batches) == self.chunks
+        self._header_sent = False
+        self._acts_sent = 0
+        self._grads_sent = 0
+        self._loss_accum.zero_()
+        self.pre_fwd_events = []
+        self.post_fwd_events = []
+
+        if self.stage > 0:
+            self._recv_shape_header()
+            # pre-post every activation receive so back-to-back sends from
+            # upstream can all be in flight; completion is consumed in
+            # schedule order, which the opportunistic reorder preserves
+            for index in self._fwd_indexes:
+                self._act_recvs.append(self._post_act_recv(index))
+
+        plan = list(self._plan)
         i=0
         count_fwd = 0
-        while (i<len(schedule)):
-            grad_mode = False
-            index, task = schedule[i]
+        while (i<len(plan)):
+            task, index, grad_mode = plan[i]
             # dynamic schedule - run forward if gradients for backward are not ready yet
-            if self.opportunistic and (task[0]==1 and count_fwd<len(self.batches) and self.grads_queue.empty()):
-            # if (task[0]==1 and count_fwd<len(self.batches) and not self.acts_queue.empty()):
+            if self.opportunistic and (task==1 and count_fwd<self.chunks and not self._grads_in_flight_ready()):
                 j=i
-                while (j<len(schedule)):
-                    if (schedule[j][1][0]==0):
-                        index, task = schedule[j]
-                        schedule.insert(i, schedule[j])
-                        del schedule[j+1]
+                while (j<len(plan)):
+                    if (plan[j][0]==0):
+                        task, index, grad_mode = plan[j]
+                        plan.insert(i, plan[j])
+                        del plan[j+1]
                         break
                     j+=1
-            if (task[0]==0):
+            if (task==0):
                 count_fwd+=1
-                if (self.schedule[index+1][0]==2):      # if next task in schedule is backward  -- no recomputation
-                    grad_mode=True
-            
+
+            # complete, on this thread, the receive this task blocks on
+            if task == 0 and self.stage > 0:
+                self.acts_queue.put(self._wait_recv(self._act_recvs.popleft()))
+            elif task == 2 and self.stage < self.partitions-1:
+                self.grads_queue.put(self._wait_recv(self._grad_recvs.popleft()))
+
             if self.verbose:
                 allocated_peak = torch.cuda.max_memory_allocated()
                 print("PEAK ALLOCATED: ", allocated_peak, force=True)
-                print(f'{self.stage} {self.rank_within_stage} task:{task[0]} {task[1]}/{len(self.batches)}\n', end="", force=True)
+                print(f'{self.stage} {self.rank_within_stage} task:{task} {index}/{self.chunks}\n', end="", force=True)
 
             try:
-                self.worker(task[0], grad_mode, self.batches[task[1]])
+                self.worker(task, grad_mode, self.batches[index])
             except Exception as e:
                 raise e
                 dist.destroy_process_group()
                 sys.exit("Error occurred, exiting!", force=True)
 
+            # ship the header once the first forward has fixed the grad
+            # shapes, then issue whatever sends this task produced
+            if self.stage < self.partitions-1 and not self._header_sent \
+                    and not self.grads_shape_queue.empty():
+                self._send_shape_header()
+                # grad shapes are final now; pre-post every grad receive
+                for idx in self._bwd_indexes:
+                    self._grad_recvs.append(self._post_grad_recv(idx))
+            self._drain_sends()
+
             i+=1
-        
+
+        self._finish_sends()
+
         if self.device != "cpu":
             torch.cuda.synchronize(self.device)
             if len(self.pre_fwd_events) > 0:
@@ -383,8 +480,10 @@ class Pipeline:
                 avg_fwd_time = avg_fwd_time / len(self.pre_fwd_events)
                 self.avg_fwd_time = avg_fwd_time
 
+        # single host read for the whole minibatch
+        self.average_loss = self._loss_accum.item()
+
         if self.pipeline_group is not None:
             torch.distributed.barrier(group=self.pipeline_group)
-        self.close_comm_threads()
         dist.barrier()
         return self.average_loss, self.avg_fwd_time
@@ -2,10 +2,11 @@ import torch
 import torch.distributed as dist
 from torch.nn import Module
 
-from .partitioned_model import CutPoint
+from .partitioned_model import CutPoint, DRY_RUN_CACHE_FILE, atomic_json_dump
 
 import os
 import time
+import json
 import pickle
 import math
 
@@ -137,7 +138,7 @@ class Profiler:
                     cutpoint.stage = -1
                     cutpoint.device = None
                     cutpoint.send_fn = None
-                    cutpoint.cp_func = None
+                    cutpoint.unset_cp_func()
             self.model.to(torch.float32)
 
 
@@ -149,7 +150,7 @@ class Profiler:
         self.input_shapes = {}
         self.num_cutpoints = 0
 
-        if self.local_rank == 0 and (not (from_cache and os.path.exists("_tmp_ord_mod") and os.path.exists("_tmp_inp_shapes"))):
+        if self.local_rank == 0 and (not (from_cache and os.path.exists(DRY_RUN_CACHE_FILE))):
 
             def get_hook(name):
                 def add_module_hook(module, inputs, _output):
@@ -174,27 +175,23 @@ class Profiler:
             for h in hooks:
                 h.remove()
 
-            with open("_tmp_ord_mod",'wb') as f:
-                pickle.dump(list(self.ordered_modules.keys()),f)
-            with open("_tmp_inp_shapes",'wb') as f:
-                pickle.dump(self.input_shapes,f)
+            meta = {"ord_mod": list(self.ordered_modules.keys()),
+                    "inp_shapes": self.input_shapes}
+            atomic_json_dump(meta, DRY_RUN_CACHE_FILE)
             dist.barrier()
 
         else:
             dist.barrier()
 
-            with open("_tmp_ord_mod",'rb') as f:
-                ordered_modules = pickle.load(f)
+            with open(DRY_RUN_CACHE_FILE,'r') as f:
+                meta = json.load(f)
+            ordered_modules = meta["ord_mod"]
 
+            module_dict = dict(self.model.named_modules())
             for n in ordered_modules:
-                path = n.split(".")
-                modules = self.model._modules
-                for i in range(len(path) - 1):
-                    modules = modules[path[i]]._modules
-                self.ordered_modules[n] = modules[path[-1]]
+                self.ordered_modules[n] = module_dict[n]
 
-            with open("_tmp_inp_shapes",'rb') as f:
-                self.input_shapes = pickle.load(f)
+            self.input_shapes = meta["inp_shapes"]
             self.num_cutpoints = len(self.input_shapes)
     
 # """ Trims out the kth stage (starting from 1) from model. """
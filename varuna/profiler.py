@@ -2,7 +2,7 @@ import torch
 import torch.distributed as dist
 from torch.nn import Module
 
-from .partitioned_model import CutPoint, dry_run, read_dry_run_out
+from .partitioned_model import CutPoint, dry_run, read_dry_run_out, dry_run_cache_valid
 
 import os
 import time
@@ -414,8 +414,7 @@ class Profiler:
         dummy_inputs = get_batch(1, device='cpu')
         self.dummy_inputs = dummy_inputs
         
-        if self.local_rank == 0 and not (from_cache and \
-            all([os.path.exists(f) for f in ["_tmp_ord_mod","_tmp_inp_shapes"]])):
+        if self.local_rank == 0 and not (from_cache and dry_run_cache_valid()):
 
             self.ordered_modules, self.input_shapes, self.shape_indices_to_change, \
                 self.num_cutpoints = dry_run(self.model, get_batch, from_cache)
@@ -454,7 +453,7 @@ class Profiler:
                 cutpoint.stage = -1
                 cutpoint.device = None
                 cutpoint.send_fn = None
-                cutpoint.cp_func = None
+                cutpoint.unset_cp_func()
 
         for n in self.orig_params:
             p = self.orig_params[n]
@@ -3,6 +3,8 @@ import os
 import socket
 import math
 
+from functools import lru_cache
+
 try:
     import torch
     from apex import amp
@@ -20,36 +22,37 @@ def scatter(input, batch_size, chunk_size):
     """
     Accepts input dictionary and splits into microbatches
     """
-    assert isinstance(input,dict) , "varuna inputs must be given as a dictionary" 
-    
-    microbatches = []
+    assert isinstance(input,dict) , "varuna inputs must be given as a dictionary"
+
     num_microbatches = math.ceil(batch_size / chunk_size)
+    # allocate the dict list once instead of growing it key by key
+    microbatches = [dict() for _ in range(num_microbatches)]
     for k,v in input.items():
         # TODO: what will happen for indivisibilities in uneven data parallelism !!
         # print(dist.get_rank(),k,v.size())
         # special case for GPT-2 attention mask
 
         if v is None:
-            chunked_values = [None for _ in range(num_microbatches)]
+            for mb in microbatches:
+                mb[k] = None
+            continue
         # for DETR: nested tensor type
         elif hasattr(v, "tensors") and hasattr(v, "mask"):
             chunked_values = v.varunafy(num_microbatches, chunk_size)
         # for DETR: target list
         elif isinstance(v, list):
             if len(v) == 1:
-                chunked_values = [v for _ in range(num_microbatches)]
+                chunked_values = [v] * num_microbatches
             else:
                 chunked_values = [v[i:i + chunk_size] for i in range(0, len(v), chunk_size)]
 
         elif v.size(0) == 1:
-            chunked_values = [v for _ in range(num_microbatches)]
+            chunked_values = [v] * num_microbatches
         else:
             chunked_values = v.split(chunk_size)
         for i,value in enumerate(chunked_values):
-            if len(microbatches) <= i:
-                microbatches.append(dict())
             microbatches[i][k]=value
-    
+
     return microbatches
 
 def save_rng_states(device):
@@ -111,20 +114,37 @@ def heartbeat(message, ip, port):
         except:
             print("Could not send progress update message")
 
+@lru_cache(maxsize=None)
+def _schedule_1f1b(partitions, chunks, stage):
+    """ 1F1B (PipeDream-flush) schedule with recomputation. Each stage runs
+    just enough warmup forwards to keep the pipe full, then alternates one
+    forward with one recompute+backward, then drains the remaining
+    backwards. Compared to running every forward up front this caps the
+    in-flight activation stashes per stage at the pipeline depth instead of
+    the number of microbatches. The last stage needs no recompute: its
+    backward immediately follows the matching forward, which run() detects
+    and turns into a grad-enabled forward.
+    """
+    last_stage = stage == partitions - 1
+    warmup = min(partitions - 1 - stage, chunks)
+
+    schedule = []
+    fwd = 0
+    for _ in range(warmup):
+        schedule.append((0, fwd))
+        fwd += 1
+    for bwd in range(chunks):
+        if fwd < chunks:
+            schedule.append((0, fwd))
+            fwd += 1
+        if not last_stage:
+            schedule.append((1, bwd))
+        schedule.append((2, bwd))
+    return tuple(schedule)
+
 def generate_schedule(chunks, stage, partitions):
     print(chunks,"chunks")
-    gensched_binary = os.path.join(os.path.dirname(os.path.abspath(__file__)),'genschedule')
-    c_schedule = os.popen( gensched_binary + ' ' +
-                            str(partitions) + ' ' +
-                            str(chunks) + ' ' +
-                            str(stage)).read()
-    schedule = list()
-    steps = c_schedule.split(';')
-    steps = steps[:-1]
-    for step in steps:
-        task = step.split(',')
-        schedule.append((int(task[0]), int(task[1])))
-    return schedule
+    return list(_schedule_1f1b(partitions, chunks, stage))
 
 def parse_stage_to_rank_map(stage_to_rank_map_str):
     """ parses the stage_to_rank_map string recieved from varuna launcher """
@@ -160,12 +180,13 @@ def get_this_rank_config_varuna(stage_to_rank_map_str, rank):
     """ parses the varuna stage_to_rank_map string and for a given rank
         returns a tuple of the form (my_stage, my_data_parallel_rank)"""
     stage_to_rank_map = parse_stage_to_rank_map(stage_to_rank_map_str)
-    for stage in stage_to_rank_map:
-        if rank in stage_to_rank_map[stage]:
-            my_stage = stage
-            my_dp_rank = stage_to_rank_map[stage].index(rank)
-            return my_stage, my_dp_rank
-    raise RuntimeError(f"rank {rank} not present in varuna config!!")
+    # invert the map once for a constant-time lookup instead of scanning
+    # every stage's rank list
+    rank_to_stage = { r: (stage, i) for stage, ranks in stage_to_rank_map.items()
+                        for i, r in enumerate(ranks) }
+    if rank not in rank_to_stage:
+        raise RuntimeError(f"rank {rank} not present in varuna config!!")
+    return rank_to_stage[rank]
 
 def is_varuna_dummy_val(val):
     if isinstance(val,tuple) and len(val)>0:
@@ -32,6 +32,9 @@ Module = nn.Module
 
 log_verbose = False
 
+# bucket size (elements) for the data-parallel gradient all-reduce
+ALLREDUCE_BUCKET_NUMEL = 64 * 1024 * 1024
+
 TASK = ["fwd", "rec", "bwd"]
     
 class Varuna(Module):
@@ -71,6 +74,10 @@ class Varuna(Module):
     :type shared_weights: list or None
     :param from_cache: Whether to use cached profiling information if available.
     :type from_cache: bool
+    :param boundary_dtype: Optional dtype (``torch.int8`` or float8) to quantize
+        inter-stage activation/gradient transfers into, with absmax scaling.
+        Lossy; off by default.
+    :type boundary_dtype: torch.dtype or None
     
     .. note::
 
@@ -92,7 +99,8 @@ class Varuna(Module):
                 device=-1,
                 shared_weights=None,
                 from_cache=True,
-                profiling_stages=None):
+                profiling_stages=None,
+                boundary_dtype=None):
         super().__init__()
 
         self.rank = dist.get_rank()
@@ -159,15 +167,18 @@ class Varuna(Module):
             "device": self.device,
             "data_depth": self.data_depth,
             "pipeline_process_group": self.pipeline_group,
+            "boundary_process_group": self.boundary_group,
             "make_logfile": False,
             "last_chunk_size": self.last_chunk_size,
             "stage_to_rank_map": self.stage_to_rank_map,
             "local_rank": self.local_rank,
             "chunk_size": chunk_size,
-            "rank_within_stage": self.rank_within_stage
+            "rank_within_stage": self.rank_within_stage,
+            "boundary_dtype": boundary_dtype
         }
 
         self.schedule = utils.generate_schedule(self.chunks, self.stage, self.partitions)
+        self.pipeline = None
         self.iteration = 0
         self.current_step = 0
 
@@ -218,12 +229,20 @@ class Varuna(Module):
         # pipeline parallel groups
         self.tied_group = None
         self.pipeline_group = None
+        # boundary activations/gradients travel as device tensors, which the
+        # default (gloo) group cannot carry; each pipeline replica gets an
+        # extra NCCL group just for those transfers. Control messages (shape
+        # headers, eval outputs) stay on the default group as CPU tensors.
+        self.boundary_group = None
         pipeline_groups = {}
         tied_groups = {}
+        boundary_groups = {}
         for replica in range(self.data_depth):
             ranks = [self.stage_to_rank_map[i][replica] for i in range(self.partitions)]
             if len(ranks) > 1:
                 pipeline_groups[replica] = dist.new_group(ranks=ranks)
+                boundary_groups[replica] = dist.new_group(ranks=ranks, backend='nccl') \
+                                            if self.device.type == "cuda" else None
                 if self.shared_weight_stages:
                     print("shared weight stages = ", self.shared_weight_stages)
                     tied_ranks = []
@@ -237,12 +256,14 @@ class Varuna(Module):
             else:
                 pipeline_groups[replica] = None
                 tied_groups[replica] = None
-            
+                boundary_groups[replica] = None
+
         current_replica = self.stage_to_rank_map[self.stage].index(self.rank)
         print("this rank ", self.rank, "is part of pipeline replica ", current_replica)
         if pipeline_groups[current_replica] is not None:
             self.pipeline_group = pipeline_groups[current_replica]
             self.tied_group = tied_groups[current_replica]
+            self.boundary_group = boundary_groups[current_replica]
 
     def configure_checkpointing(self):
         self.param_name_to_pstage = self.partitioned_model.parameter_names_to_cuts()
@@ -282,8 +303,11 @@ class Varuna(Module):
         self.config["make_logfile"] = bool(self.config["make_logfile"] and self.current_step < 5)
         batch_time = time.time()
 
-        self.pipeline = Pipeline(batches, self.model, self.config, self.schedule, self.optimizer, verbose=log_verbose)
-        self.average_loss, fwd_time = self.pipeline.run()
+        # the pipeline is built once and reused; only the microbatches
+        # change between steps
+        if self.pipeline is None:
+            self.pipeline = Pipeline(self.model, self.config, self.schedule, self.optimizer, verbose=log_verbose)
+        self.average_loss, fwd_time = self.pipeline.run(batches)
 
         if log_verbose:
             print(f'{self.stage} {self.rank_within_stage} going to share embedding grads')
@@ -545,11 +569,19 @@ class Varuna(Module):
                     if parameter_names[p] in w:
                         my_params.append(p)
 
+                grads = [p.grad for p in my_params if p.grad is not None]
+                if len(grads) == 1:
+                    # common case: a single local copy of the tied weight;
+                    # reduce its grad in place instead of staging it
+                    # through a zeros buffer and copying back
+                    if len(stages) > 1:
+                        dist.all_reduce(grads[0].data, group=self.tied_group)
+                    continue
+
                 # local variable to collect all values to be reduced
                 accumulated_grad = torch.zeros_like(my_params[0].grad)
-                for p in my_params:
-                    if p.grad is not None:
-                        accumulated_grad.add_(p.grad)
+                for g in grads:
+                    accumulated_grad.add_(g)
 
                 # share accumulated grad
                 if len(stages) > 1:
@@ -584,7 +616,13 @@ class Varuna(Module):
 
         if self.data_parallel:
             allred_time_start = time.time()
-            torch.distributed.all_reduce(flat_raw, group=self.dp_group)
+            # launch the reduction as async bucket-sized calls so the
+            # transport pipelines them instead of one monolithic blocking
+            # all-reduce over the whole flat gradient
+            handles = [ torch.distributed.all_reduce(bucket, group=self.dp_group, async_op=True)
+                        for bucket in flat_raw.split(ALLREDUCE_BUCKET_NUMEL) ]
+            for handle in handles:
+                handle.wait()
         
         if log_verbose:
             print(f'{self.rank} {self.rank_within_stage} gradient all-reduce done')